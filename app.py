@@ -1,9 +1,17 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import datetime
 import math
+import bisect
+import functools
 import re
-import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+import numpy as np
+import diskcache
 # pandasの読み込みを削除して高速化
 
 # ---------------------------------------------------------
@@ -21,11 +29,54 @@ JST = datetime.timezone(datetime.timedelta(hours=9), 'JST')
 # 定数設定
 LAT = 34.61  # 明石海峡大橋付近
 LON = 135.02
+# 1日の潮流イベント（転流・最強）は多くても8件程度。余裕を見てここで打ち切る
+_MAX_TIDE_EVENTS = 12
+# 潮データが取れない時の予測計算の基準時刻
+_TIDE_CALC_BASE = datetime.datetime(2024, 1, 1, 0, 0)
+
+# 正規表現とHTTPセッションは全ユーザー・再実行をまたいで使い回す
+@st.cache_resource
+def _tide_regex():
+    """tide736.net の潮流表（時刻・流向）を抜き出す正規表現"""
+    return re.compile(r"<td>(\d{1,2}:\d{2})</td>\s*<td><span[^>]*?>([^<]*?)</span></td>")
+
+@st.cache_resource
+def _http_session():
+    """Keep-Alive で接続を使い回すセッション。リトライもアダプタ側に任せる"""
+    # 風(open-meteo)と潮(tide736)は別ホストなので HTTP/2 にしても1本の接続で多重化はできない。
+    # ホストごとの Keep-Alive 接続で十分なので requests のまま使う
+    s = requests.Session()
+    s.mount("https://", HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            # 待ち時間で他のユーザーを止めないよう、429（アクセス集中）は再試行せず、
+            # 503 などの Retry-After も無視して短いバックオフだけで再試行する
+            status_forcelist=(500, 502, 503, 504),
+            respect_retry_after_header=False,
+            allowed_methods=("GET",),
+            raise_on_status=False,
+        ),
+    ))
+    return s
+
+@st.cache_resource
+def _tide_disk_cache():
+    """潮流データのディスクキャッシュ（再起動・再デプロイ後も残る）"""
+    return diskcache.Cache(".tide_cache")
 
 # ---------------------------------------------------------
 # 2. 関数定義（ロジック部分）
 # ---------------------------------------------------------
 
+class WindSeries(NamedTuple):
+    """1時間刻みの風予報（base_dt からの経過時間で配列を引く）"""
+    base_dt: datetime.datetime
+    wind_speeds: np.ndarray
+    wind_dirs: np.ndarray
+
 @st.cache_data(ttl=3600) # キャッシュを1時間に設定
 def get_wind_data_hourly(days=8):
     """Open-Meteoから週間風予報を取得 (軽量版)"""
@@ -40,42 +91,35 @@ def get_wind_data_hourly(days=8):
         "past_days": 1 
     }
     
-    last_error = None
-    # リトライ回数を5回
-    for attempt in range(5):
-        try:
-            r = requests.get(url, params=params, timeout=20)
-            r.raise_for_status()
-            
-            data = r.json()
-            hourly = data["hourly"]
-            result = {}
-            
-            for i, t_str in enumerate(hourly["time"]):
-                # pandasを使わず標準機能だけで日付変換（高速）
-                dt = datetime.datetime.strptime(t_str, "%Y-%m-%dT%H:%M")
-                result[dt] = {
-                    "wind_speed": hourly["wind_speed_10m"][i],
-                    "wind_dir": hourly["wind_direction_10m"][i]
-                }
-            return result, None
-            
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 429:
-                last_error = f"アクセス集中 (429): {e}"
-                wait_time = 5 + (attempt * 3)
-                time.sleep(wait_time)
-                continue
-            else:
-                last_error = e
-                time.sleep(2)
-                continue
-        except Exception as e:
-            last_error = e
-            time.sleep(2)
-            continue
-            
-    return None, last_error
+    try:
+        r = _http_session().get(url, params=params, timeout=20)
+        r.raise_for_status()
+        
+        data = r.json()
+        hourly = data["hourly"]
+        # Open-Meteoの時刻は1時間刻みで連続しているので先頭だけ変換すればよい
+        result = WindSeries(
+            base_dt=datetime.datetime.fromisoformat(hourly["time"][0]),
+            wind_speeds=np.array(hourly["wind_speed_10m"], dtype=float),
+            wind_dirs=np.array(hourly["wind_direction_10m"], dtype=float),
+        )
+        return result, None
+        
+    except requests.exceptions.HTTPError as e:
+        if e.response.status_code == 429:
+            return None, f"アクセス集中 (429): {e}"
+        return None, e
+    except (requests.RequestException, KeyError, IndexError, ValueError, TypeError) as e:
+        return None, e
+
+def get_wind_hours(wind_data, day_start, hours):
+    """day_start からの各時刻の風を配列で取り出す。範囲外・欠測の時刻は除く"""
+    idx = int((day_start - wind_data.base_dt).total_seconds() // 3600) + hours
+    in_range = (idx >= 0) & (idx < len(wind_data.wind_speeds))
+    hours, idx = hours[in_range], idx[in_range]
+    speeds, dirs = wind_data.wind_speeds[idx], wind_data.wind_dirs[idx]
+    valid = ~(np.isnan(speeds) | np.isnan(dirs))
+    return hours[valid], speeds[valid], dirs[valid]
 
 @st.cache_data(ttl=3600)
 def get_real_tide_data(target_date):
@@ -84,142 +128,156 @@ def get_real_tide_data(target_date):
     url = f"https://tide736.net/current/?area=28&loc=akashi&date={date_str}"
     headers = {"User-Agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 15_0 like Mac OS X)"}
     
+    # 一度取得した日付はディスクから返す（24時間で期限切れ）。キャッシュが使えない時は飛ばして取りに行く
     try:
-        r = requests.get(url, headers=headers, timeout=10)
-        r.encoding = r.apparent_encoding
-        matches = re.findall(r"<td>(\d{1,2}:\d{2})</td>\s*<td><span.*?>(.*?)</span></td>", r.text)
-        
+        cached = _tide_disk_cache().get(date_str)
+    except Exception:
+        cached = None
+    if cached is not None:
+        return cached
+    
+    try:
+        r = _http_session().get(url, headers=headers, timeout=10)
+        # tide736.net は UTF-8 固定なので文字コード推定（apparent_encoding）は使わない
+        text = r.content.decode("utf-8", errors="replace")
         events = []
-        for m in matches:
-            time_str, label_raw = m
-            dt_str = f"{target_date.strftime('%Y-%m-%d')} {time_str}"
-            dt = datetime.datetime.strptime(dt_str, "%Y-%m-%d %H:%M")
+        for m in _tide_regex().finditer(text):
+            time_str, label_raw = m.group(1), m.group(2)
+            hh, mm = time_str.split(":")
+            dt = datetime.datetime(target_date.year, target_date.month, target_date.day, int(hh), int(mm))
             
             if "西" in label_raw: d, l = 270, "西流"
             elif "東" in label_raw: d, l = 90, "東流"
             else: d, l = None, "転流"
             events.append({"time": dt, "dir": d, "label": l})
-        return events
+            if len(events) >= _MAX_TIDE_EVENTS:
+                break
     except:
         return None
+    
+    if events:
+        try:
+            _tide_disk_cache().set(date_str, events, expire=86400)
+        except Exception:
+            pass
+    return events
 
-def get_tide_status(dt, tide_events):
-    """潮流判定"""
+def get_tide_status(dt, tide_events, tide_times=None):
+    """潮流判定（tide_times は時刻順に並んだ各イベントの時刻。無ければ1回なめて探す）"""
     if tide_events:
-        closest = min(tide_events, key=lambda e: abs((dt - e["time"]).total_seconds()))
+        if tide_times is not None:
+            i = bisect.bisect_right(tide_times, dt)
+            past = tide_events[i - 1] if i else tide_events[0]
+            future = tide_events[i] if i < len(tide_events) else None
+            closest = past if (future is None or dt - past["time"] <= future["time"] - dt) else future
+        else:
+            # 並び順を仮定せず、最寄り・直前・直後を1回のループでまとめて探す
+            closest = None
+            best_diff = float("inf")
+            last_past = None
+            first_future = None
+            for e in tide_events:
+                d = (dt - e["time"]).total_seconds()
+                ad = abs(d)
+                if ad < best_diff:
+                    best_diff, closest = ad, e
+                if d >= 0:
+                    last_past = e
+                elif first_future is None:
+                    first_future = e
+            past = last_past or tide_events[0]
+            future = first_future
         diff_min = abs((dt - closest["time"]).total_seconds()) / 60
         
         if closest["label"] == "転流" and diff_min <= 40:
             return {"dir": None, "label": "潮止まり", "type": "real"}
         
-        past = [e for e in tide_events if e["time"] <= dt]
-        current = past[-1] if past else tide_events[0]
-        if current["label"] == "転流":
-            future = [e for e in tide_events if e["time"] > dt]
-            if future: current = future[0]
+        current = past
+        if current["label"] == "転流" and future:
+            current = future
         return {"dir": current["dir"], "label": current["label"], "type": "real"}
 
-    base_time = datetime.datetime(2024, 1, 1, 0, 0)
-    diff_hours = (dt - base_time).total_seconds() / 3600
+    return _tide_status_calc(int((dt - _TIDE_CALC_BASE).total_seconds() // 3600))
+
+@functools.lru_cache(maxsize=512)
+def _tide_status_calc(diff_hours):
+    """基準時刻からの経過時間（時）で潮流を予測（結果は共有されるので書き換えないこと）"""
     cycle = math.sin(diff_hours * 2 * math.pi / 12.4)
     if cycle > 0.3: return {"dir": 270, "label": "西流(予)", "type": "calc"}
     elif cycle < -0.3: return {"dir": 90, "label": "東流(予)", "type": "calc"}
     else: return {"dir": None, "label": "潮止まり", "type": "calc"}
 
-def judge_seat_detailed(wind_dir, tide_dir, wind_speed):
-    """詳細な座席判定ロジック"""
-    if tide_dir is None or wind_speed < 1.0:
-        return "判断不可", "#b2bec3"
+# 相対角度の区切り（右ミヨシ → 右舷 胴 → 右トモ → 左トモ → 左舷 胴 → 左ミヨシ）
+_SEAT_EDGES = np.array([45, 135, 180, 225, 315])
+_SEAT_NAMES = np.array(["🟢右ミヨシ(前)", "🟢右舷 胴", "🟢右トモ(後)", "🔴左トモ(後)", "🔴左舷 胴", "🔴左ミヨシ(前)"])
+_SEAT_COLORS = np.array(["#00b894", "#55efc4", "#00cec9", "#6c5ce7", "#fab1a0", "#e17055"])
+_WIND_LABELS = np.array(("北","北東","東","南東","南","南西","西","北西"))
 
-    boat_heading = wind_dir
-    rel = (tide_dir - boat_heading) % 360
+# 相対角度（整数度）→ 座席の表。区切りが整数なので小数の角度も切り捨てで同じ座席になる
+_SEAT_TABLE = np.searchsorted(_SEAT_EDGES, np.arange(360), side="right")
+_SEAT_TABLE_NAMES = _SEAT_NAMES[_SEAT_TABLE]
+_SEAT_TABLE_COLORS = _SEAT_COLORS[_SEAT_TABLE]
+
+def judge_seat_detailed(wind_dirs, tide_dirs, wind_speeds):
+    """詳細な座席判定ロジック（配列でまとめて判定。潮向きが無い時刻は NaN）"""
+    undecidable = np.isnan(tide_dirs) | (wind_speeds < 1.0)
     
-    if 0 <= rel < 45:
-        return "🟢右ミヨシ(前)", "#00b894"
-    elif 45 <= rel < 135:
-        return "🟢右舷 胴", "#55efc4"
-    elif 135 <= rel < 180:
-        return "🟢右トモ(後)", "#00cec9"
-    elif 180 <= rel < 225:
-        return "🔴左トモ(後)", "#6c5ce7"
-    elif 225 <= rel < 315:
-        return "🔴左舷 胴", "#fab1a0"
-    elif 315 <= rel < 360:
-        return "🔴左ミヨシ(前)", "#e17055"
-        
-    return "-", "#b2bec3"
+    boat_heading = wind_dirs
+    rel = np.nan_to_num((tide_dirs - boat_heading) % 360).astype(int) % 360
+    
+    names = np.where(undecidable, "判断不可", _SEAT_TABLE_NAMES[rel])
+    colors = np.where(undecidable, "#b2bec3", _SEAT_TABLE_COLORS[rel])
+    return names, colors
 
 def get_wind_label(d):
-    dirs = ["北","北東","東","南東","南","南西","西","北西"]
-    return dirs[int((d + 22.5)%360/45)]
+    """風向（度・配列）を8方位の表記に変換"""
+    return _WIND_LABELS[((d + 22.5) % 360 // 45).astype(int)]
 
-# ---------------------------------------------------------
-# 3. アプリ画面構築
-# ---------------------------------------------------------
-
-st.markdown('<p style="font-weight:bold; color:#555; margin-bottom:-20px;">どこの釣り座が釣れるかここでチェック！</p>', unsafe_allow_html=True)
-st.title("魔釣の明石釣り座チェッカー 🎣")
-
-# 日付選択
-now_jst = datetime.datetime.now(JST)
-today = now_jst.date()
+@st.cache_data(ttl=300)
+def build_table_html(selected_date, wind_key, tide_key, _wind_data, _tide_events):
+    """9時間分の判定表のHTMLを作る（データが無ければ None）
+    
+    _wind_data / _tide_events はハッシュせず、wind_key / tide_key でキャッシュを引く
+    """
+    wind_data, tide_events = _wind_data, _tide_events
+    day_start = datetime.datetime.combine(selected_date, datetime.time())
+    hours, wind_speeds, wind_dirs = get_wind_hours(wind_data, day_start, np.arange(5, 14))
 
-dates = [today + datetime.timedelta(days=i) for i in range(8)]
-date_options = {d: d.strftime("%m/%d (%a)") for d in dates}
+    # 時刻順に並んでいる時だけ bisect 用の時刻リストを渡す（並んでいなければ get_tide_status が1回なめて探す）
+    tide_times = [e["time"] for e in tide_events] if tide_events else None
+    if tide_times and any(a > b for a, b in zip(tide_times, tide_times[1:])):
+        tide_times = None
+    tides = [get_tide_status(day_start + datetime.timedelta(hours=int(h)), tide_events, tide_times) for h in hours]
+    tide_dirs = np.array([np.nan if t["dir"] is None else t["dir"] for t in tides], dtype=float)
+    seat_names, color_codes = judge_seat_detailed(wind_dirs, tide_dirs, wind_speeds)
+    wind_strs = get_wind_label(wind_dirs)
 
-selected_date = st.selectbox(
-    "日付を選んでください",
-    options=dates,
-    format_func=lambda x: date_options[x]
-)
+    row_parts = []
+    count_data = len(hours)
+    # 座席バッジのスタイルは背景色以外共通なので先に作っておく
+    seat_style_base = "color:white; padding:4px 8px; border-radius:12px; font-weight:bold; font-size:0.9rem; display:inline-block; width:100%; text-align:center; white-space: nowrap;"
 
-# データ取得
-with st.spinner("気象データを解析しています..."):
-    wind_data, error_msg = get_wind_data_hourly(8)
-    
-    if wind_data is None or len(wind_data) == 0:
-        st.error("⚠️ 気象データの取得に失敗しました。")
-        if error_msg:
-            st.warning("現在アクセスが集中しています。")
-            with st.expander("詳細エラーログ"):
-                st.code(str(error_msg))
-            st.info("💡 1分ほど時間を空けてから、再度リロード（更新）してみてください。")
-        st.stop()
+    for h, wind_speed, t, seat_name, color_code, wind_str in zip(hours, wind_speeds, tides, seat_names, color_codes, wind_strs):
+        tide_style = "color:#636e72;"
+        if "西" in t["label"]: tide_style = "color:#d63031; font-weight:bold;"
+        elif "東" in t["label"]: tide_style = "color:#0984e3; font-weight:bold;"
         
-    tide_events = get_real_tide_data(selected_date)
-
-# 結果表示用HTML生成
-rows = ""
-count_data = 0
-
-for h in range(5, 14):
-    dt = datetime.datetime.combine(selected_date, datetime.time(hour=h))
-    
-    w = wind_data.get(dt)
-    if not w:
-        continue
-    
-    count_data += 1
-    t = get_tide_status(dt, tide_events)
-    seat_name, color_code = judge_seat_detailed(w["wind_dir"], t["dir"], w["wind_speed"])
-    wind_str = get_wind_label(w["wind_dir"])
-    
-    tide_style = "color:#636e72;"
-    if "西" in t["label"]: tide_style = "color:#d63031; font-weight:bold;"
-    elif "東" in t["label"]: tide_style = "color:#0984e3; font-weight:bold;"
-    
-    seat_style = f"background-color:{color_code}; color:white; padding:4px 8px; border-radius:12px; font-weight:bold; font-size:0.9rem; display:inline-block; width:100%; text-align:center; white-space: nowrap;"
-    
-    rows += f"""
+        seat_style = f"background-color:{color_code}; {seat_style_base}"
+        
+        row_parts.append(f"""
 <tr style="border-bottom: 1px solid #eee;">
 <td style="padding:10px; font-weight:bold; background:#f9f9f9;">{h}:00</td>
-<td style="padding:10px; text-align:center;">{w['wind_speed']:.1f}m<br><span style="font-size:0.8em; color:#666;">{wind_str}</span></td>
+<td style="padding:10px; text-align:center;">{wind_speed:.1f}m<br><span style="font-size:0.8em; color:#666;">{wind_str}</span></td>
 <td style="padding:10px; text-align:center; {tide_style}">{t['label']}</td>
 <td style="padding:10px; text-align:center;"><span style="{seat_style}">{seat_name}</span></td>
-</tr>"""
+</tr>""")
 
-if count_data > 0:
-    html_table = f"""
+    rows = "".join(row_parts)
+    
+    if count_data == 0:
+        return None
+    
+    return f"""
 <div style="background:white; border-radius:10px; box-shadow:0 2px 5px rgba(0,0,0,0.1); overflow:hidden; margin-top:10px;">
 <table style="width:100%; border-collapse:collapse; font-size:0.95em;">
 <thead style="background:#dfe6e9; color:#2d3436;">
@@ -236,16 +294,66 @@ if count_data > 0:
 </table>
 </div>
 """
-    st.markdown(html_table, unsafe_allow_html=True)
-else:
-    st.warning(f"⚠️ {selected_date.strftime('%m/%d')} の予報データが見つかりませんでした。")
 
-st.write("")
-st.caption("※船を立てる（スパンカー使用）船専用の判定です。")
-if tide_events:
-    st.caption(f"潮データ: WEB実測値")
-else:
-    st.caption("潮データ: 自動予測計算")
+# ---------------------------------------------------------
+# 3. アプリ画面構築
+# ---------------------------------------------------------
+
+st.markdown('<p style="font-weight:bold; color:#555; margin-bottom:-20px;">どこの釣り座が釣れるかここでチェック！</p>', unsafe_allow_html=True)
+st.title("魔釣の明石釣り座チェッカー 🎣")
+
+# 日付の切り替えではこの部分だけを再実行する（ページ全体は再実行しない）
+@st.fragment
+def render_table():
+    # 日付選択
+    now_jst = datetime.datetime.now(JST)
+    today = now_jst.date()
+
+    dates = [today + datetime.timedelta(days=i) for i in range(8)]
+    date_options = {d: d.strftime("%m/%d (%a)") for d in dates}
+
+    selected_date = st.selectbox(
+        "日付を選んでください",
+        options=dates,
+        format_func=lambda x: date_options[x]
+    )
+
+    # データ取得（風と潮は独立しているので並列で取りに行く）
+    with st.spinner("気象データを解析しています..."):
+        ctx = get_script_run_ctx()
+        with ThreadPoolExecutor(max_workers=2, initializer=add_script_run_ctx, initargs=(None, ctx)) as ex:
+            f_wind = ex.submit(get_wind_data_hourly, 8)
+            f_tide = ex.submit(get_real_tide_data, selected_date)
+            wind_data, error_msg = f_wind.result()
+            tide_events = f_tide.result()
+    
+        if wind_data is None or len(wind_data.wind_speeds) == 0:
+            st.error("⚠️ 気象データの取得に失敗しました。")
+            if error_msg:
+                st.warning("現在アクセスが集中しています。")
+                with st.expander("詳細エラーログ"):
+                    st.code(str(error_msg))
+                st.info("💡 1分ほど時間を空けてから、再度リロード（更新）してみてください。")
+            return
+
+    # 結果表示用HTML生成（日付とデータが変わらない限りキャッシュから返す）
+    wind_key = (wind_data.base_dt, wind_data.wind_speeds.tobytes(), wind_data.wind_dirs.tobytes())
+    tide_key = tuple((e["time"], e["label"]) for e in tide_events) if tide_events else None
+    html_table = build_table_html(selected_date, wind_key, tide_key, wind_data, tide_events)
+
+    if html_table:
+        st.markdown(html_table, unsafe_allow_html=True)
+    else:
+        st.warning(f"⚠️ {selected_date.strftime('%m/%d')} の予報データが見つかりませんでした。")
+
+    st.write("")
+    st.caption("※船を立てる（スパンカー使用）船専用の判定です。")
+    if tide_events:
+        st.caption(f"潮データ: WEB実測値")
+    else:
+        st.caption("潮データ: 自動予測計算")
+
+render_table()
 
 # ---------------------------------------------------------
 # 4. 姉妹アプリへのリンク